@@ -5,112 +5,249 @@
 A simple module for convenient molecule I/O
 """
 
+import io
 import os
+import re
+import sys
 import gzip
+import heapq
+import functools
+import logging
+import mmap
+import multiprocessing
+import queue
+import pickle
 import random
 import tempfile
+import threading
 from pathlib import Path
+from operator import attrgetter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import cmder
-import vstool
 
-logger = vstool.setup_logger()
+try:
+    from isal import igzip as gzip_reader
+except ImportError:
+    gzip_reader = gzip
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+READ_BUFFER_SIZE = 128 * 1024
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+_UNSET = object()
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+_ENERGY_RE = re.compile(r'=\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+_SCORE_RE = re.compile(r'^(?:(ENERGY[^\n]*LOWER_BOUND[^\n]*)|>[^\n]*<score>[^\n]*(?=(?:\n([^\n]*))?))', re.MULTILINE)
+_DLG_ATOM_RE = re.compile(r'^DOCKED: ((?:ATOM|ROOT|ENDROOT|BRANCH|ENDBRANCH)[^\n]*\n?)', re.MULTILINE)
+_DLG_NAME_RE = re.compile(r'^DOCKED: REMARK Name =[ \t]*([^\n]*?)[ \t\r]*$', re.MULTILINE)
+_DLG_ENERGY_RE = re.compile(r'^DOCKED: ([^\n]*Estimated Free Energy of Binding[^\n]*)', re.MULTILINE)
+_CONTENT_RE = re.compile(rb'\S')
 
 
 def _opener(path):
     return gzip.open if str(path).endswith('.gz') else open
 
 
+def _line(s, start):
+    end = s.find('\n', start)
+    return s[start:] if end < 0 else s[start:end]
+
+
+def _iter_lines(s):
+    i, n = 0, len(s)
+    while i < n:
+        j = s.find('\n', i)
+        if j < 0:
+            yield s[i:]
+            break
+        yield s[i:j + 1]
+        i = j + 1
+
+
+def _reader(path):
+    raw = io.BufferedReader(gzip_reader.open(path, 'rb'), buffer_size=READ_BUFFER_SIZE)
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
 class SDF:
+    __slots__ = ('s', '_score', '_title', '_mol')
+
     def __init__(self, s):
         self.s = s
-        self.score, self.title, self.mol = self.parse(s)
+        self._score = self._title = self._mol = _UNSET
+
+    @classmethod
+    def from_lines(cls, lines):
+        return cls(''.join(lines))
+
+    @classmethod
+    def _from_fields(cls, s, score, title=_UNSET, mol=_UNSET):
+        sdf = cls.__new__(cls)
+        sdf.s, sdf._score, sdf._title, sdf._mol = s, score, title, mol
+        return sdf
+
+    def __reduce__(self):
+        s, score, title, mol = self.s, self.score, self._title, self._mol
+        start, end = self._mol_span(s)
+        if title == self._parse_title(s) and len(mol) == end - start and s.startswith(mol, start):
+            return self._from_fields, (s, score)
+        return self._from_fields, (s, score, title, mol)
+
+    def _parse_fields(self):
+        s = self.s
+        start, end = self._mol_span(s)
+        if self._score is _UNSET:
+            self._score = self._parse_score(s, end)
+        if self._title is _UNSET:
+            self._title = self._parse_title(s)
+        if self._mol is _UNSET:
+            self._mol = s[start:end]
+
+    @property
+    def score(self):
+        if self._score is _UNSET:
+            self._parse_fields()
+        return self._score
+
+    @score.setter
+    def score(self, value):
+        self._score = value
+
+    @property
+    def title(self):
+        if self._title is _UNSET:
+            self._parse_fields()
+        return self._title
+
+    @title.setter
+    def title(self, value):
+        self._title = value
+
+    @property
+    def mol(self):
+        if self._mol is _UNSET:
+            self._parse_fields()
+        return self._mol
+
+    @mol.setter
+    def mol(self, value):
+        self._mol = value
 
     @staticmethod
     def parse(s):
-        if s:
-            lines = s.splitlines(keepends=True)
-            title = lines[0].rstrip()
-
-            mol, i, score = [], 0, None
-            for i, line in enumerate(lines[1:]):
-                mol.append(line)
-                if line.strip() == 'M  END':
-                    break
-            mol = ''.join(mol)
-
-            for j, line in enumerate(lines[i + 2:]):
-                if line.startswith('ENERGY') and 'LOWER_BOUND' in line:
-                    try:
-                        score = float(line.split('=')[1].lstrip().split()[0])
-                    except Exception as e:
-                        logger.error(f'Failed to get docking score from {line.strip()} due to {e}')
-                        score = None
-                elif line.startswith('>') and '<score>' in line:
-                    line = lines[i + 2:][j + 1]
-                    try:
-                        score = float(line.strip())
-                    except Exception as e:
-                        logger.error(f'Failed to get docking score from {line.strip()} due to {e}')
-                        score = None
-        else:
-            score, title, mol = None, '', ''
-        return score, title, mol
+        if not s:
+            return None, '', ''
+        start, end = SDF._mol_span(s)
+        return SDF._parse_score(s, end), SDF._parse_title(s), s[start:end]
 
-    def sdf(self, output=None, title=''):
-        score = '' if self.score is None else f'> <score>\n{self.score}'
-        if self.mol:
-            s = f'{title or self.title}\n{self.mol}'
-            if score:
-                s = f'{s}\n{score}\n'
-            s = f'{s}\n$$$$\n'
-        else:
-            s = '\n'
+    @staticmethod
+    def _parse_title(s):
+        nl = s.find('\n')
+        return (s if nl < 0 else s[:nl]).rstrip()
 
+    @staticmethod
+    def _mol_span(s):
+        nl = s.find('\n')
+        if nl < 0:
+            return len(s), len(s)
+        idx = s.find('\nM  END', nl)
+        end = -1 if idx < 0 else s.find('\n', idx + 1)
+        return nl + 1, len(s) if end < 0 else end + 1
+
+    @staticmethod
+    def _parse_score(s, end):
+        score = None
+        for m in _SCORE_RE.finditer(s, end):
+            energy, item = m.groups()
+            line = energy or item or ''
+            try:
+                score = float(_ENERGY_RE.search(line).group(1) if energy else line.strip())
+            except Exception as e:
+                logger.error(f'Failed to get docking score from {line.strip()} due to {e}')
+                score = None
+        return score
+
+    def _parts(self, title=''):
+        if self._score is _UNSET or self._title is _UNSET or self._mol is _UNSET:
+            self._parse_fields()
+        mol, score = self._mol, self._score
+        if not mol:
+            return '\n',
+        if score is None:
+            return title or self._title, '\n', mol, '\n$$$$\n'
+        return title or self._title, '\n', mol, '\n> <score>\n', str(score), '\n\n$$$$\n'
+
+    def write_to(self, fh, title=''):
+        fh.writelines(self._parts(title))
+
+    def sdf(self, output=None, title=''):
         if output:
-            if s:
-                output, opener = Path(output), _opener(output)
-                with opener(output, 'wt') as o:
-                    o.write(s)
-                return output
-            else:
-                return None
+            output, opener = Path(output), _opener(output)
+            with opener(output, 'wt') as o:
+                self.write_to(o, title=title)
+            return output
         else:
-            return s
+            return ''.join(self._parts(title))
 
     def __str__(self):
         return self.s
 
 
 class DLG:
-    def __init__(self, s):
+    __slots__ = ('s', 'score', 'title', 'atom', 'coords')
+
+    def __init__(self, s, parse_coords=False):
         self.s = s
         self.score, self.title, self.atom = self.parse(s)
+        self.coords = self.parse_coords(self.atom) if parse_coords else None
+
+    @classmethod
+    def from_lines(cls, lines, parse_coords=False):
+        return cls(''.join(lines), parse_coords=parse_coords)
 
     @staticmethod
     def parse(s):
-        score, atom, title = None, [], ''
-        prefix, lines = 'DOCKED: ', s.splitlines(keepends=True)
-        for i, line in enumerate(lines):
-            if line.startswith(prefix):
-                line = line.removeprefix(prefix)
-                if line.strip().split()[0] in ('ATOM', 'ROOT', 'ENDROOT', 'BRANCH', 'ENDBRANCH'):
-                    atom.append(line)
-                elif 'Estimated Free Energy of Binding' in line:
-                    try:
-                        score = float(line.split('=')[1].lstrip().split()[0])
-                    except Exception as e:
-                        logger.error(f'Failed to get docking score due to {e}:\n{line}')
-                elif 'REMARK Name =' in line:
-                    title = line.strip().split(' = ')[1]
-        return score, title, ''.join(atom)
+        score, title = None, ''
+        atom = ''.join(_DLG_ATOM_RE.findall(s))
+        m = _DLG_NAME_RE.search(s)
+        if m:
+            title = sys.intern(m.group(1))
+        m = _DLG_ENERGY_RE.search(s)
+        if m:
+            line = m.group(1)
+            try:
+                score = float(_ENERGY_RE.search(line).group(1))
+            except Exception as e:
+                logger.error(f'Failed to get docking score due to {e}:\n{line}')
+        return score, title, atom
+
+    @staticmethod
+    def parse_coords(atom):
+        import numpy as np
+
+        xyz = [(float(line[30:38]), float(line[38:46]), float(line[46:54]))
+               for line in _iter_lines(atom) if line.startswith('ATOM')]
+        return np.array(xyz, dtype=np.float32).reshape(-1, 3)
 
     def pdbqt(self, output=None, title=''):
         title = title or self.title
         if self.atom:
-            s = [f'REMARK  Name = {title}' if title else '', '' if self.score is None else f'score {self.score}',
-                 self.atom]
-            s = '\n'.join([x for x in s if x])
+            s = ''.join((f'REMARK  Name = {title}\n' if title else '',
+                         '' if self.score is None else f'score {self.score}\n', self.atom))
             if output:
                 with open(output, 'w') as o:
                     o.write(s)
@@ -121,63 +258,386 @@ class DLG:
             return ''
 
     def sdf(self, output=None, title=''):
-        _, pdbqt = tempfile.mkstemp(suffix='.pdbqt')
-        _, _sdf = tempfile.mkstemp(suffix='.sdf')
-        try:
-            self.pdbqt(output=pdbqt, title=title)
-            p = cmder.run(f'obabel {pdbqt} -o sdf -O {_sdf}', exit_on_error=False, fmt_cmd=False, log_cmd=False)
-            if p.returncode:
-                logger.error('Failed to write molecule to SDF file')
-                return ''
-            else:
-                with open(_sdf) as f:
-                    lines = (line for line in f
-                             if not line.startswith('>  <REMARK>') and not line.startswith('  Name ='))
-                    lines = ('\n' if 'OpenBabel' in line else line for line in lines)
-                    if output:
-                        with open(output, 'w') as o:
-                            o.writelines(line for line in lines)
-                        return output
-                    else:
-                        return ''.join(lines)
-        finally:
-            os.unlink(pdbqt)
-            os.unlink(_sdf)
+        return dlgs_to_sdf([self], output=output, title=title)
 
     def __str__(self):
         return self.s
 
 
-def parse_sdf(sdf):
-    path = str(sdf)
-    opener = gzip.open if path.endswith('.sdf.gz') or path.endswith('.sdfgz') else open
-    with opener(path, 'rt') as f:
-        lines = []
-        for i, line in enumerate(f):
-            lines.append(line)
-            if line.strip() == '$$$$':
-                yield SDF(''.join(lines))
-                lines = []
-                continue
-        yield SDF(''.join(lines))
+@functools.lru_cache(maxsize=None)
+def _pybel():
+    try:
+        from openbabel import pybel
+    except ImportError:
+        return None
+    return pybel
 
 
-def parse_dlg(dlg):
-    path = str(dlg)
-    opener = gzip.open if path.endswith('.gz') else open
-    with opener(path, 'rt') as f:
-        lines = []
-        for line in f:
-            if line.startswith('DOCKED: MODEL'):
+def _clean_obabel_sdf(lines, output=None):
+    lines = (line for line in lines if not line.startswith('>  <REMARK>') and not line.startswith('  Name ='))
+    lines = ('\n' if 'OpenBabel' in line else line for line in lines)
+    if output:
+        with open(output, 'w') as o:
+            o.writelines(lines)
+        return output
+    else:
+        return ''.join(lines)
+
+
+def _obabel_sdf(tmp, blocks):
+    pdbqt, sdf = os.path.join(tmp, 'ligand.pdbqt'), os.path.join(tmp, 'ligand.sdf')
+    with open(pdbqt, 'w') as o:
+        for n, s in enumerate(blocks, 1):
+            o.write(f'MODEL {n:>8}\n')
+            o.write(s if s.endswith('\n') else f'{s}\n')
+            o.write('ENDMDL\n')
+
+    p = cmder.run(f'obabel {pdbqt} -o sdf -O {sdf}', exit_on_error=False, fmt_cmd=False, log_cmd=False)
+    if p.returncode:
+        logger.error('Failed to write molecule to SDF file')
+        return None
+    with open(sdf) as f:
+        return f.read()
+
+
+def dlgs_to_sdf(dlgs, output=None, title=''):
+    pybel = _pybel()
+    if pybel is not None:
+        sdfs = []
+        for block in (dlg.pdbqt(title=title) for dlg in dlgs):
+            if block:
+                try:
+                    sdfs.append(pybel.readstring('pdbqt', block).write('sdf'))
+                except Exception as e:
+                    logger.error(f'Failed to write molecule to SDF file due to {e}')
+        s = ''.join(sdfs)
+        return _clean_obabel_sdf(_iter_lines(s), output=output) if s else ''
+
+    blocks = [s for s in (dlg.pdbqt(title=title) for dlg in dlgs) if s]
+    if not blocks:
+        return ''
+
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmp:
+        s = _obabel_sdf(tmp, blocks)
+        if s is None and len(blocks) > 1:
+            logger.warning(f'Failed to convert {len(blocks):,} poses in one batch, converting them one by one')
+            s = ''.join(filter(None, (_obabel_sdf(tmp, [block]) for block in blocks)))
+        return _clean_obabel_sdf(_iter_lines(s), output=output) if s else ''
+
+
+def _record_ends(buf, final=True):
+    i = j = 0
+    while (j := buf.find(b'$$$$', j)) >= 0:
+        end = buf.find(b'\n', j + 4)
+        if end < 0:
+            if not final:
                 break
-        for line in f:
-            if line.startswith('DOCKED: ENDMDL'):
-                yield DLG(''.join(lines))
-                lines = []
+            end = len(buf)
+        else:
+            end += 1
+        if (j == i or buf[j - 1] == 10) and not buf[j + 4:end].strip():
+            yield end
+            i = end
+        j = end
+
+
+def _iter_records(buf):
+    i = 0
+    for end in _record_ends(buf):
+        yield buf[i:end]
+        i = end
+    yield buf[i:]
+
+
+def _stream_records(f, size=1 << 20):
+    buf = bytearray()
+    while chunk := f.read(size):
+        buf += chunk
+        i = 0
+        for end in _record_ends(buf, final=False):
+            yield buf[i:end]
+            i = end
+        del buf[:i]
+    yield from _iter_records(buf)
+
+
+def _prefetch(items, batch=256, maxsize=64):
+    q, stop = queue.Queue(maxsize=maxsize), threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
-            lines.append(line)
+        return False
+
+    def produce():
+        try:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == batch:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if put(chunk):
+                put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while (chunk := q.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _decode(record):
+    s = record.decode('utf-8')
+    return s.replace('\r\n', '\n') if '\r' in s else s
+
+
+def _open_cache(cache):
+    f = open(cache, 'rb')
+    if f.peek(4)[:4] != _ZSTD_MAGIC:
+        return f
+    if zstandard is None:
+        f.close()
+        return None
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f), buffer_size=READ_BUFFER_SIZE)
+
+
+def _cache_writer(fd):
+    o = os.fdopen(fd, 'wb')
+    return zstandard.ZstdCompressor().stream_writer(o) if zstandard else o
+
+
+def _cached_parse_sdf(path):
+    cache = f'{path}.sdfcache'
+    f = None
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        f = _open_cache(cache)
+    if f:
+        with f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    break
+                for item in batch:
+                    yield SDF._from_fields(*item)
+        return
+
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.sdfcache', dir=os.path.dirname(os.path.abspath(path)))
+    except OSError as e:
+        logger.debug(f'Failed to create cache for {path} due to {e}, parse it without caching')
+        yield from parse_sdf(path)
+        return
+
+    try:
+        with _cache_writer(fd) as o:
+            batch = []
+            for sdf in parse_sdf(path):
+                batch.append((sdf.s, sdf.score))
+                if len(batch) == 1000:
+                    pickle.dump(batch, o, protocol=pickle.HIGHEST_PROTOCOL)
+                    batch = []
+                yield sdf
+            pickle.dump(batch, o, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def parse_sdf(sdf, cache=False):
+    path = str(sdf)
+    if cache:
+        yield from _cached_parse_sdf(path)
+    elif path.endswith('.sdf.gz') or path.endswith('.sdfgz'):
+        with gzip_reader.open(path, 'rb') as f:
+            for record in _prefetch(_stream_records(f)):
+                yield SDF(_decode(record))
+    else:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for record in _iter_records(mm):
+                        yield SDF(_decode(record))
+            else:
+                yield SDF('')
+
+
+def _has_index(path):
+    index = f'{path}.gzi'
+    return os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(path)
+
+
+def _open_indexed(path):
+    f = indexed_gzip.IndexedGzipFile(path, spacing=4 << 20, buffer_size=READ_BUFFER_SIZE)
+    index = f'{path}.gzi'
+    if _has_index(path):
+        f.import_index(index)
+    else:
+        f.build_full_index()
+        try:
+            f.export_index(index)
+        except OSError as e:
+            logger.debug(f'Failed to save gzip index to {index} due to {e}, keep it in memory')
+    return f
+
+
+def _line_start(f, offset, step=4096):
+    while offset > 0:
+        lo = max(offset - step, 0)
+        f.seek(lo)
+        idx = f.read(offset - lo).rfind(b'\n')
+        if idx >= 0:
+            return lo + idx + 1
+        offset = lo
+    return 0
 
-        yield DLG(''.join(lines))
+
+def parse_sdf_range(sdf, start, end):
+    path = str(sdf)
+    compressed = path.endswith('.sdf.gz') or path.endswith('.sdfgz')
+    if compressed:
+        f = _open_indexed(path) if indexed_gzip else gzip_reader.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    with f:
+        pos = _line_start(f, start)
+        owned = pos == start == 0
+        if 0 < pos == start:
+            prev = _line_start(f, pos - 1)
+            f.seek(prev)
+            line = f.read(pos - prev)
+            owned = line.startswith(b'$$$$') and not line[4:].strip()
+
+        f.seek(pos)
+        for i, record in enumerate(_stream_records(f)):
+            if pos >= end and (record or pos > end or start >= end):
+                break
+            if i or owned:
+                yield SDF(_decode(record))
+            pos += len(record)
+
+
+def _parse_range(path, start, end):
+    return list(parse_sdf_range(path, start, end))
+
+
+def _build_batch(records):
+    return [SDF(_decode(record)) for record in records]
+
+
+def _parse_batches(path, workers, batch=1000):
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(method)
+    with gzip_reader.open(path, 'rb') as f, ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending, records = deque(), []
+        for record in _prefetch(_stream_records(f)):
+            records.append(record)
+            if len(records) == batch:
+                pending.append(executor.submit(_build_batch, records))
+                records = []
+                if len(pending) > workers * 2:
+                    yield from pending.popleft().result()
+        pending.append(executor.submit(_build_batch, records))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def parse_sdf_parallel(sdf, workers=None, batch=1000, shard=64 << 20):
+    path = str(sdf)
+    workers = workers or os.cpu_count() or 1
+    compressed = path.endswith('.sdf.gz') or path.endswith('.sdfgz')
+    if compressed and indexed_gzip is None:
+        yield from _parse_batches(path, workers, batch=batch)
+        return
+
+    if compressed:
+        with _open_indexed(path) as f:
+            size = f.seek(0, io.SEEK_END)
+        if not _has_index(path):
+            logger.debug(f'No saved gzip index for {path}, parse it in batches instead of shards')
+            yield from _parse_batches(path, workers, batch=batch)
+            return
+    else:
+        size = os.path.getsize(path)
+    if not size:
+        yield SDF('')
+        return
+
+    n = min(max(workers * 4, -(-size // shard)), size)
+    bounds = [size * i // n for i in range(n + 1)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in zip(bounds, bounds[1:]):
+            pending.append(executor.submit(_parse_range, path, start, end))
+            if len(pending) > workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _find_line(buf, prefix, start=0):
+    if buf[start:start + len(prefix)] == prefix:
+        return start
+    idx = buf.find(b'\n' + prefix, start)
+    return idx if idx < 0 else idx + 1
+
+
+def _next_line(buf, start):
+    idx = buf.find(b'\n', start)
+    return len(buf) if idx < 0 else idx + 1
+
+
+def _iter_poses(buf):
+    i = _find_line(buf, b'DOCKED: MODEL')
+    if i < 0:
+        yield b''
+        return
+
+    i = _next_line(buf, i)
+    while (j := _find_line(buf, b'DOCKED: ENDMDL', i)) >= 0:
+        yield buf[i:j]
+        i = _next_line(buf, j)
+    yield buf[i:]
+
+
+def parse_dlg(dlg, parse_coords=False):
+    path = str(dlg)
+    if path.endswith('.gz'):
+        with _reader(path) as f:
+            lines = []
+            for line in f:
+                if line.startswith('DOCKED: MODEL'):
+                    break
+            for line in f:
+                if line.startswith('DOCKED: ENDMDL'):
+                    yield DLG.from_lines(lines, parse_coords=parse_coords)
+                    lines = []
+                    continue
+                lines.append(line)
+
+            yield DLG.from_lines(lines, parse_coords=parse_coords)
+    else:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for pose in _iter_poses(mm):
+                        yield DLG(_decode(pose), parse_coords=parse_coords)
+            else:
+                yield DLG('', parse_coords=parse_coords)
 
 
 def parse(path):
@@ -208,14 +668,67 @@ def write(records, output=None, outdir=None):
                 outputs.append(record.sdf(output=f'{outdir}/{record.title or i}.sdf'))
         logger.debug(f'Successfully saved {len(outputs):,} items into {outdir}')
     else:
-        return ''.join(record for record in records if record)
+        return (record.sdf() for record in records if record)
 
 
 def count_sdf(sdf):
-    return sum(1 for m in parse_sdf(sdf) if m.mol)
+    path = str(sdf)
+    opener = gzip_reader.open if path.endswith('.gz') or path.endswith('.sdfgz') else open
+    n, pending, buf = 0, False, bytearray()
+    with opener(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            buf += chunk
+            i = 0
+            for i in _record_ends(buf, final=False):
+                n += 1
+            j = max(buf.rfind(b'\n', i) + 1, i)
+            pending = pending and not i or bool(_CONTENT_RE.search(buf, i, j))
+            del buf[:j]
+    i = 0
+    for i in _record_ends(buf):
+        n += 1
+    return n + (pending and not i or bool(_CONTENT_RE.search(buf, i)))
+
+
+def _copy_range(f, start, end, output):
+    with _opener(output)(output, 'wb') as o:
+        if hasattr(os, 'sendfile') and not str(output).endswith('.gz'):
+            while start < end:
+                sent = os.sendfile(o.fileno(), f.fileno(), start, end - start)
+                if not sent:
+                    break
+                start += sent
+        else:
+            f.seek(start)
+            while start < end and (chunk := f.read(min(1 << 20, end - start))):
+                o.write(chunk)
+                start += len(chunk)
+    return Path(output)
+
+
+def _split_raw(sdf, prefix, suffix='.sdf', num=0):
+    names = []
+    with open(sdf, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return names
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bounds = [0]
+            if num:
+                for i, end in enumerate(_record_ends(mm), 1):
+                    if i % num == 0:
+                        bounds.append(end)
+            if _CONTENT_RE.search(mm, bounds[-1]):
+                bounds.append(size)
+
+        for idx, (start, end) in enumerate(zip(bounds, bounds[1:]), 1):
+            names.append(_copy_range(f, start, end, f'{prefix}{idx}{suffix}'))
+    logger.debug(f'Successfully split {sdf} into {len(names):,} files')
+    return names
 
 
-def split_sdf(sdf, prefix, suffix='.sdf', files=0, records=0):
+def split_sdf(sdf, prefix, suffix='.sdf', files=0, records=0, raw=False):
     names = []
     if files:
         n = count_sdf(sdf)
@@ -223,6 +736,9 @@ def split_sdf(sdf, prefix, suffix='.sdf', files=0, records=0):
         if remains:
             num += 1
 
+        if raw and not str(sdf).endswith('gz'):
+            return _split_raw(sdf, prefix, suffix=suffix, num=num)
+
         idx, end, items = 1, num, []
         for i, item in enumerate(parse_sdf(sdf), 1):
             items.append(item)
@@ -235,6 +751,8 @@ def split_sdf(sdf, prefix, suffix='.sdf', files=0, records=0):
         if items[:-1]:
             name = write(items[:-1], output=f'{prefix}{idx}{suffix}')
             names.append(name)
+    elif raw and not str(sdf).endswith('gz'):
+        return _split_raw(sdf, prefix, suffix=suffix, num=records)
     elif records:
         idx, n, items = 0, records - 1, []
         for i, item in enumerate(parse_sdf(sdf), 0):
@@ -256,72 +774,63 @@ def split_sdf(sdf, prefix, suffix='.sdf', files=0, records=0):
 
 
 def sample_sdf(sdf, output, n=0, p=0.0, seed=None):
-    logger.debug(f'Counting number of compounds in {sdf}')
-    total = count_sdf(sdf)
-    if n:
-        logger.debug(f'Try to sample {n:,} compounds out of {total:,} compounds')
-    elif p:
-        n = int(total * p / 100)
-        logger.debug(f'Try to sample {n:,} ({p}%) compounds out of {total:,} compounds')
-    else:
+    if not n and not p:
         raise ValueError('Neither number of compounds (n) nor percentage of compounds (p) was specified, aborted!')
 
-    if n <= total:
+    random.seed(seed)
+    opener = gzip.open if str(output).endswith('.sdf.gz') or str(output).endswith('.sdfgz') else open
+    if n:
         logger.debug(f'Sampling {n:,} compounds from {sdf}')
+        reservoir, total = [], 0
+        for s in parse_sdf(sdf):
+            if s.mol:
+                if total < n:
+                    reservoir.append((total, s))
+                else:
+                    j = random.randrange(total + 1)
+                    if j < n:
+                        reservoir[j] = (total, s)
+                total += 1
+
+        if total < n:
+            raise ValueError(f'No enough compounds ({total} < {n}) found in {sdf} to sample')
+
+        logger.debug(f'Saving {n:,} compounds out of {total:,} compounds into {output}')
+        with opener(output, 'wt') as o:
+            o.writelines(s.sdf() for _, s in sorted(reservoir, key=lambda x: x[0]))
     else:
-        raise ValueError(f'No enough compounds ({total} < {n}) found in {sdf} to sample')
+        logger.debug(f'Sampling {p}% compounds from {sdf} into {output}')
+        n, rate = 0, p / 100
+        with opener(output, 'wt') as o:
+            for s in parse_sdf(sdf):
+                if s.mol and random.random() < rate:
+                    o.write(s.sdf())
+                    n += 1
+    logger.debug(f'Successfully saved {n:,} compounds into {output}')
 
-    logger.debug(f'Selecting random compounds')
-    random.seed(seed)
-    indices, ss = set(random.sample(range(total), n)), []
-    for i, s in enumerate(parse_sdf(sdf)):
-        if i in indices:
-            ss.append(s)
 
-    logger.debug(f'Saving {len(ss):,} compounds into {output}')
-    opener = gzip.open if str(output).endswith('.sdf.gz') or str(output).endswith('.sdfgz') else open
-    with opener(output, 'wt') as o:
-        o.writelines(s.sdf() for s in ss if s.mol)
-    logger.debug(f'Successfully saved {len(ss):,} compounds into {output}')
-
-    # random.seed(seed)
-    # indices = sorted(random.sample(range(total), n))
-    # step = 1000
-    # chunks = [indices[step * i: step * (i + 1)] for i in range(int(n / step) + 1)]
-    #
-    # ss, idx = [], 0
-    # idx = 0
-    # chunk, upper = chunks[idx], chunks[idx][-1]
-    # for i, s in enumerate(parse_sdf(sdf)):
-    #     if i < upper:
-    #         if i in chunk:
-    #             ss.append(s)
-    #     elif i == upper:
-    #         ss.append(s)
-    #         idx += 1
-    #         try:
-    #             chunk, upper = chunks[idx], chunks[idx][-1]
-    #         except IndexError:
-    #             break
-    #
-    # opener = gzip.open if str(output).endswith('.sdf.gz') or str(output).endswith('.sdfgz') else open
-    # with opener(output, 'wt') as o:
-    #     o.writelines(s.sdf() for s in ss if s.mol)
-
-
-def merge_sdf(sdfs, output, sort=None, max_score=0):
-    items = []
+def _scored_records(sdfs, max_score=0, workers=0):
     for sdf in sdfs:
         logger.debug(f'Parsing {sdf} ...')
-        for s in parse_sdf(sdf):
+        for s in (parse_sdf_parallel(sdf, workers=workers) if workers else parse_sdf(sdf)):
             if s.score is not None and s.score < max_score:
-                items.append(s)
+                yield s
 
-    n = len(items)
-    if sort:
-        logger.debug(f'Sorting {n:,} docking poses on docking score {sort} ...')
-        items = sorted(items, key=lambda x: x.score, reverse=False if sort == 'descending' else True)
-        logger.debug(f'Sorting {n:,} docking poses on docking score {sort} complete.')
+
+def merge_sdf(sdfs, output, sort=None, max_score=0, workers=0, top_k=None):
+    if top_k:
+        logger.debug(f'Selecting top {top_k:,} docking poses on docking score ...')
+        items = heapq.nsmallest(top_k, _scored_records(sdfs, max_score, workers), key=attrgetter('score'))
+        if sort and sort != 'descending':
+            items.reverse()
+        logger.debug(f'Selecting top {len(items):,} docking poses on docking score complete.')
+    else:
+        items = list(_scored_records(sdfs, max_score, workers))
+        n = len(items)
+        if sort:
+            logger.debug(f'Sorting {n:,} docking poses on docking score {sort} ...')
+            items.sort(key=attrgetter('score'), reverse=sort != 'descending')
+            logger.debug(f'Sorting {n:,} docking poses on docking score {sort} complete.')
 
     write(items, output)
     return output
@@ -341,33 +850,21 @@ def batch_sdf(sdf, n, prefix):
 
 def clean_sdf(sdf, output=None):
     items = [sdf] if isinstance(sdf, SDF) else parse(sdf)
-    s = ''.join(s.sdf() for s in items)
-    if output is None:
-        return s
+    if output is None or not (output or isinstance(sdf, str)):
+        return ''.join(s.sdf() for s in items)
     else:
-        if output:
-            with open(output, 'w') as o:
-                o.write(s)
-            return output
-        else:
-            if isinstance(sdf, str):
-                output = str(Path(sdf).with_suffix('.clean.sdf'))
-                with open(output, 'w') as o:
-                    o.write(s)
-                return output
-            else:
-                return s
+        output = output or str(Path(sdf).with_suffix('.clean.sdf'))
+        with open(output, 'w') as o:
+            o.writelines(s.sdf() for s in items)
+        return output
 
 
 def dlg2sdf(dlg, sdf=None, title=''):
-    s = ''.join(f'{item.sdf(title=title)}' for item in parse_dlg(dlg))
     if sdf is None:
-        return s
+        return dlgs_to_sdf(parse_dlg(dlg), title=title)
     else:
         sdf = sdf or str(Path(dlg).with_suffix('.sdf'))
-        with open(sdf, 'w') as o:
-            o.write(s)
-        return sdf
+        return dlgs_to_sdf(parse_dlg(dlg), output=sdf, title=title)
 
 
 if __name__ == '__main__':